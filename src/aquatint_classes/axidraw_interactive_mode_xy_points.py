@@ -1,10 +1,26 @@
-import time
+import os
 import json
+import argparse
+import itertools
+import codecs
+import numpy as np
 from pyaxidraw import axidraw  # import module
 
 # Used this tool to convert svg path to point path in mm
 # https://spotify.github.io/coordinator/
 
+# Points are streamed from disk and sent to draw_path in chunks of this many
+# points, so memory use stays flat no matter how long the path is. Each
+# draw_path call ends with a pen lift, so keep this large to keep the number
+# of lifts (and the small dots they can leave) down.
+CHUNK_SIZE = 50000
+# Bytes read from a json points file per read call
+READ_BLOCK_SIZE = 1 << 16
+# Longest a single "[x, y]" point may be in a json points file
+MAX_POINT_CHARS = 1024
+# Extensions of raw little endian float64 x, y pair files
+RAW_EXTENSIONS = (".bin", ".f64")
+
 ad = axidraw.AxiDraw()  # Initialize class
 
 
@@ -18,15 +34,204 @@ def print_position():
     print(f"Actual position: {current_position[0]:0.3f}, {current_position[1]:0.3f}\n")
 
 
-def add_current_pos_to_path(point_list, xy):
-    for i, _point in enumerate(point_list):
-        point_list[i] = [_point[0] + xy[0], _point[1] + xy[1]]
-    return point_list
+def add_current_pos_to_path(points, xy):
+    "Offset an (n, 2) array of points by the current position of AxiDraw head"
+    return points + np.asarray(xy[:2], dtype=float)
+
+
+def is_point(point):
+    "A point is a list of at least two numbers, [x, y, ...]"
+    return (
+        isinstance(point, list)
+        and len(point) >= 2
+        and all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) for v in point[:2]
+        )
+    )
+
+
+def stream_json_points(filename, chunk_size=CHUNK_SIZE):
+    """
+    Incrementally parse a json list of [x, y] pairs, yielding (n, 2) arrays
+    of at most chunk_size points along with the fraction of the file read.
+    Raises ValueError, with the byte offset, on anything else.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    total_bytes = os.path.getsize(filename) or 1
+    bytes_read = 0
+    # Bytes of the file already dropped from the front of buf
+    buf_offset = 0
+    buf = ""
+    pos = 0
+    eof = False
+    # start -> first -> sep -> item -> sep ... -> done
+    state = "start"
+    chunk = []
+
+    def error(msg):
+        byte_offset = buf_offset + len(buf[:pos].encode("utf-8"))
+        raise ValueError(f"{filename}: {msg} at byte {byte_offset}")
+
+    with open(filename, "rb") as f:
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            in_point = pos < len(buf) and buf[pos] == "[" and state in ("first", "item")
+            close = buf.find("]", pos) if in_point else -1
+            if pos == len(buf) or (in_point and close < 0):
+                # Need more data, either the buffer is used up or a point is cut off
+                if eof:
+                    if state == "done" and pos == len(buf):
+                        break
+                    error("Unexpected end of file")
+                if len(buf) - pos > MAX_POINT_CHARS:
+                    error("Point too long")
+                block = f.read(READ_BLOCK_SIZE)
+                bytes_read += len(block)
+                eof = not block
+                buf_offset += len(buf[:pos].encode("utf-8"))
+                buf = buf[pos:] + utf8.decode(block, final=eof)
+                pos = 0
+                continue
+
+            c = buf[pos]
+            if state == "start":
+                if c != "[":
+                    error("Expected a json list of points")
+                state = "first"
+                pos += 1
+            elif state == "sep":
+                if c not in ",]":
+                    error("Expected ',' or ']'")
+                state = "item" if c == "," else "done"
+                pos += 1
+            elif state == "done":
+                error("Unexpected data after end of list")
+            elif c == "]" and state == "first":
+                state = "done"
+                pos += 1
+            elif c != "[":
+                error("Expected a [x, y] point")
+            else:
+                try:
+                    point = decoder.decode(buf[pos : close + 1])
+                except json.JSONDecodeError:
+                    point = None
+                if not is_point(point):
+                    error("Malformed point")
+                chunk.append(point[:2])
+                state = "sep"
+                pos = close + 1
+                if len(chunk) == chunk_size:
+                    yield np.asarray(chunk, dtype=float), bytes_read / total_bytes
+                    chunk = []
+    if chunk:
+        yield np.asarray(chunk, dtype=float), 1.0
+
+
+def open_binary_points(filename):
+    """
+    Memory map a binary points file, either a .npy array of shape (n, 2) or
+    raw little endian float64 x, y pairs, checking its shape or size.
+    """
+    if filename.lower().endswith(".npy"):
+        points = np.load(filename, mmap_mode="r")
+        if points.ndim != 2 or points.shape[1] < 2:
+            raise ValueError(f"{filename}: expected shape (n, 2), got {points.shape}")
+        return points
+    size = os.path.getsize(filename)
+    if size % 16:
+        raise ValueError(
+            f"{filename}: size {size} is not a whole number of float64 x, y pairs"
+        )
+    if not size:
+        return np.empty((0, 2))
+    return np.memmap(filename, dtype="<f8", mode="r").reshape(-1, 2)
+
+
+def stream_binary_points(filename, chunk_size=CHUNK_SIZE):
+    """
+    Yield (n, 2) array chunks of a binary points file along with the
+    fraction of points read.
+    """
+    points = open_binary_points(filename)
+    n_points = len(points) or 1
+    for start in range(0, len(points), chunk_size):
+        end = min(start + chunk_size, len(points))
+        yield np.array(points[start:end, :2], dtype=float), end / n_points
+
+
+def stream_points(filename, chunk_size=CHUNK_SIZE):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".json":
+        return stream_json_points(filename, chunk_size)
+    if ext == ".npy" or ext in RAW_EXTENSIONS:
+        return stream_binary_points(filename, chunk_size)
+    raise ValueError(
+        f"{filename}: unknown points file type, expected .json, .npy, "
+        + ", ".join(RAW_EXTENSIONS)
+    )
+
 
+def check_points_file(filename, full=False):
+    """
+    Check a points file before the AxiDraw moves: it exists, is a supported
+    type and, for binary files, has the right shape or size. A json file is
+    only parsed as it is plotted, so with full=False a malformed point is
+    found partway through the plot. full=True streams the whole file.
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"No points file {filename}")
+    stream = stream_points(filename)
+    if filename.lower().endswith(".json"):
+        # Only reading the first chunk catches a file that is the wrong format
+        stream = stream if full else itertools.islice(stream, 1)
+    elif not full:
+        open_binary_points(filename)
+        return
+    return sum(len(chunk) for chunk, _ in stream)
 
-# Load in points file
-with open("points.json") as f:
-    points = json.load(f)
+
+def draw_path_in_chunks(filename, xy, chunk_size=CHUNK_SIZE):
+    """
+    Offset each streamed chunk by xy and plot it. Every chunk after the
+    first starts at the last point of the previous one so the drawn line
+    stays continuous across chunk boundaries. draw_path still lifts the
+    pen at the end of each chunk and lowers it again at that shared point,
+    which can leave a small dot, hence the large CHUNK_SIZE.
+    """
+    last_point = None
+    n_points = 0
+    for i, (chunk, progress) in enumerate(stream_points(filename, chunk_size)):
+        chunk = add_current_pos_to_path(chunk, xy)
+        n_points += len(chunk)
+        if last_point is not None:
+            chunk = np.vstack((last_point, chunk))
+        ad.draw_path(chunk.tolist())  # Plot this piece of the path
+        last_point = chunk[-1]
+        print(f"Chunk {i + 1}: {n_points} points plotted ({progress:.1%})")
+    return n_points
+
+
+# Load in points file, json or binary (.npy / .bin or .f64 raw float64 pairs).
+# The file is checked before connecting, but a json file is only fully parsed
+# as it is plotted, so run with --check first to validate it end to end.
+parser = argparse.ArgumentParser(description="Plot a points file on the AxiDraw")
+parser.add_argument("points_file", nargs="?", default="points.json")
+parser.add_argument(
+    "--check", action="store_true", help="validate the whole file, don't plot"
+)
+args = parser.parse_args()
+points_file = args.points_file
+try:
+    n_points = check_points_file(points_file, full=args.check)
+except (OSError, ValueError) as e:
+    print(f"Error: {e}")
+    quit()
+if args.check:
+    print(f"{points_file}: {n_points} points OK")
+    quit()
 
 ad.interactive()  # Enter interactive context
 if not ad.connect():  # Open serial port to AxiDraw;
@@ -50,8 +255,7 @@ try:
     ad.update()
     xy = ad.current_pos()
     # Have to add mm path to current pos to make it draw relative to where it is
-    points = add_current_pos_to_path(points, xy)
-    ad.draw_path(points)  # Plot the path
+    draw_path_in_chunks(points_file, xy)  # Plot the path
     print_position()
     input()
 except Exception as e:
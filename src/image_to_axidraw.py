@@ -1,48 +1,333 @@
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 from aquatint_classes.programmatic_aquatint import ProgrammaticAquatint
-from aquatint_classes.programmatic_svg import ProgrammaticSvgManipulator
 
 """
-# Image to aquatint file
-n_aquatint_pixels = "MAX"
-aq = ProgrammaticAquatint(
-    "imgs/rocks_and_sea_crop_3_v2.jpg",
-    "output",
-    n_aquatint_pixels=n_aquatint_pixels,
-    # sample_rate=1.5,
-    use_sampled_image=False,
-    # use_sampled_image=True,
-    # data_channel_division_factor=10,
-    data_channel_division_factor=15,
-    # data_channel_division_factor=2.5,
-    # data_channel_division_factor=1,
-    # data_channel_division_factor=40,
-    # data_channel_division_factor=60,
-    # data_channel_division_factor=30,
-    # plot_point_size=0.008,
-    # plot_point_size=0.05,
-    # plot_point_size=0.8,
-    plot_point_size=0.5,
-    # plot_point_size=0.9,
-    # plot_point_size=0.3,
-    # plot_point_size=0.2,
-)
-aq_file = aq.aquatint()
-"""
+Image(s) to aquatint file(s), and optionally on to the AxiDraw.
 
-# Hardcode file name if you are ready to plot and don't want to redo the above
-aq_file = "output/FINAL_DONT_OVERWRITE/9by12_printed_proofs/rocks_and_sea_crop_3_v2/div_factor_15_point_size_0p5/aquatint_pixel_concat.csv"
+Generate one image:
+    python image_to_axidraw.py imgs/rocks_and_sea_crop_3_v2.jpg --div-factor 15 --point-size 0.5
 
-# Aquatint file to axidraw
-psm = ProgrammaticSvgManipulator(aq_file)
-psm.calc_xy_size()
-# psm.axidraw_xy_bounding_box()
-# psm.axidraw_calibrate()
-# psm.axidraw_xy_dots_inches()
+Generate many images/parameter sets concurrently from a job file:
+    python image_to_axidraw.py --jobs jobs.json --workers 4
 
+where jobs.json runs every image with every parameter set, e.g.
+    {
+        "output": "output",
+        "images": ["imgs/rocks_and_sea_crop_3_v2.jpg", "imgs/rocks_and_sea_crop_4_v3.jpg"],
+        "params": [
+            {"data_channel_division_factor": 15, "plot_point_size": 0.5},
+            {"data_channel_division_factor": 10, "plot_point_size": 0.95}
+        ]
+    }
+
+Plot an existing aquatint file without redoing the above:
+    python image_to_axidraw.py --aq-file output/.../aquatint_pixel_concat.csv --plot size
 """
-# This is still under construction. The input file here is an svg, not an image.
-# Aquatint file to axidraw with SVG paths translated to x,y points
-svg = "glyph_dictionary_lines/35.svg"
-print(f"Loading in {aq_file}...")
-print(f"Loading in svg image path {svg}...")
-"""
+
+AQ_FILE_NAME = "aquatint_pixel_concat.csv"
+# Parameters an aquatint file was made with, used to tell if it is up to date
+PARAMS_FILE_NAME = "params.json"
+
+# AxiDraw actions that can be run on each aquatint file, see ProgrammaticSvgManipulator
+PLOT_ACTIONS = {
+    "size": "calc_xy_size",
+    "bounding_box": "axidraw_xy_bounding_box",
+    "calibrate": "axidraw_calibrate",
+    "dots": "axidraw_xy_dots_inches",
+}
+# Actions that draw on the plate
+DRAW_ACTIONS = ("bounding_box", "calibrate", "dots")
+
+
+def cls_log(msg):
+    print(f"[image_to_axidraw] {msg}")
+    return
+
+
+def load_jobs(jobs_file):
+    "Expand a job file into a list of (image_path, output_path, params) jobs"
+    with open(jobs_file) as f:
+        spec = json.load(f)
+    if not isinstance(spec.get("images"), list):
+        raise ValueError(f'{jobs_file}: job file needs an "images" list')
+    output_path = spec.get("output", "output")
+    params = spec.get("params", [{}])
+    return [
+        (os.path.normpath(image_path), output_path, dict(_params))
+        for image_path, _params in itertools.product(spec["images"], params)
+    ]
+
+
+def job_aquatint(image_path, output_path, params):
+    """
+    ProgrammaticAquatint for a job. Its output folder is named after the image
+    file only, ProgrammaticAquatint's own naming only works for relative
+    imgs/<name>.<ext> paths.
+    """
+    aq = ProgrammaticAquatint(image_path, output_path, **params)
+    image_name = os.path.splitext(os.path.basename(image_path))[0]
+    aq.image_output_path = os.path.join(
+        output_path, image_name, os.path.basename(aq.image_output_path)
+    )
+    output_root = os.path.abspath(output_path)
+    image_output_root = os.path.abspath(os.path.join(output_path, image_name))
+    if (
+        image_output_root == output_root
+        or os.path.commonpath([output_root, image_output_root]) != output_root
+    ):
+        raise ValueError(f"output folder for {image_path} is not inside {output_path}")
+    return aq
+
+
+def job_record(aq):
+    "Everything that goes into an aquatint file, saved next to it as PARAMS_FILE_NAME"
+    return {
+        "image_path": aq.image_path,
+        "n_aquatint_pixels": aq.n_aquatint_pixels,
+        "sample_rate": aq.sample_rate,
+        "use_sampled_image": aq.use_sampled_image,
+        "data_channel_division_factor": aq.data_channel_division_factor,
+        "plot_point_size": aq.plot_point_size,
+    }
+
+
+def is_up_to_date(aq):
+    """
+    An aquatint file is up to date if it is newer than its source image and
+    was made with the same parameters
+    """
+    aq_file = os.path.join(aq.image_output_path, AQ_FILE_NAME)
+    params_file = os.path.join(aq.image_output_path, PARAMS_FILE_NAME)
+    if not (os.path.exists(aq_file) and os.path.exists(params_file)):
+        return False
+    if os.path.getmtime(aq_file) < os.path.getmtime(aq.image_path):
+        return False
+    with open(params_file) as f:
+        try:
+            return json.load(f) == job_record(aq)
+        except json.JSONDecodeError:
+            return False
+
+
+def init_worker():
+    # Workers only save figures, don't let aquatint_plot block on plt.show()
+    import matplotlib.pyplot as plt
+
+    plt.switch_backend("Agg")
+
+
+def run_job(image_path, output_path, params):
+    "Generate one aquatint file, run in a worker process"
+    start = time.time()
+    aq = job_aquatint(image_path, output_path, params)
+    # Only write params once the aquatint is done, so a crashed job is never
+    # taken for up to date
+    params_file = os.path.join(aq.image_output_path, PARAMS_FILE_NAME)
+    os.path.exists(params_file) and os.remove(params_file)
+    aq_file = aq.aquatint()
+    with open(params_file, "w") as f:
+        json.dump(job_record(aq), f, indent=4)
+    return aq_file, time.time() - start
+
+
+def plot(aq_file, action):
+    "Send an aquatint file to the AxiDraw. Only ever called from the main process."
+    # Imported here so generating aquatint files doesn't need pyaxidraw
+    from aquatint_classes.programmatic_svg import ProgrammaticSvgManipulator
+
+    psm = ProgrammaticSvgManipulator(aq_file)
+    getattr(psm, PLOT_ACTIONS[action])()
+    return
+
+
+def run_jobs(jobs, workers=None, action=None, force=False):
+    """
+    Generate aquatint files for all jobs on a process pool. Files are plotted
+    one at a time from this process as they finish, up to date ones first,
+    while the pool keeps generating, since there is only one AxiDraw.
+    """
+    start = time.time()
+    n_skipped, n_failed, n_done = 0, 0, 0
+    plot_queue = []
+
+    # Group jobs by output folder. ProgrammaticAquatint doesn't put every
+    # parameter in the folder name, so different jobs can share one, and
+    # running them would overwrite each other's files.
+    targets = {}
+    for job in jobs:
+        try:
+            aq = job_aquatint(*job)
+        except (TypeError, ValueError) as e:
+            cls_log(f"Error: {job[0]} {job[2]}: {e}")
+            n_failed += 1
+            continue
+        targets.setdefault(aq.image_output_path, {})
+        # Identical jobs are only run once
+        targets[aq.image_output_path].setdefault(json.dumps(job_record(aq)), (job, aq))
+
+    pending = []
+    for image_output_path, target_jobs in targets.items():
+        if len(target_jobs) > 1:
+            cls_log(
+                f"Error: {len(target_jobs)} jobs with different parameters would "
+                f"all write to {image_output_path}, not running them:"
+            )
+            for job, _ in target_jobs.values():
+                cls_log(f"    {job[0]} {job[2]}")
+            n_failed += len(target_jobs)
+            continue
+        (job, aq), = target_jobs.values()
+        if not os.path.exists(aq.image_path):
+            cls_log(f"Error: {aq.image_path} {job[2]}: image not found")
+            n_failed += 1
+        elif not force and is_up_to_date(aq):
+            cls_log(f"Up to date, skipping {image_output_path}")
+            n_skipped += 1
+            plot_queue.append(os.path.join(image_output_path, AQ_FILE_NAME))
+        else:
+            pending.append(job)
+    checked = time.time()
+
+    # Plotting stays serial, on the one hardware queue
+    n_plotted, n_plot_failed, plot_elapsed = 0, 0, 0.0
+
+    def plot_next(aq_file):
+        nonlocal n_plotted, n_plot_failed, plot_elapsed
+        if action in DRAW_ACTIONS and n_plotted + n_plot_failed:
+            # Every plot starts at the same origin, give a chance to change the paper
+            input(f"Change the paper, then press Enter to plot {aq_file} ({action})")
+        cls_log(f"Plotting {aq_file} ({action})")
+        plot_start = time.time()
+        try:
+            plot(aq_file, action)
+            n_plotted += 1
+        except Exception as e:
+            cls_log(f"Error: plotting {aq_file}: {e}")
+            n_plot_failed += 1
+        plot_elapsed += time.time() - plot_start
+
+    # Time generation by when jobs finish, not when they are collected here,
+    # which can be held up by plotting
+    finished = []
+    pool = None
+    futures = {}
+    if pending:
+        cls_log(f"Running {len(pending)} job(s) on {workers or os.cpu_count()} workers")
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+        futures = {pool.submit(run_job, *job): job for job in pending}
+        for future in futures:
+            future.add_done_callback(lambda _: finished.append(time.time()))
+    try:
+        for aq_file in plot_queue:
+            action and plot_next(aq_file)
+        for future in as_completed(futures):
+            image_path, _, params = futures[future]
+            try:
+                aq_file, elapsed = future.result()
+            except Exception as e:
+                cls_log(f"Error: {image_path} {params}: {e}")
+                n_failed += 1
+                continue
+            n_done += 1
+            cls_log(f"[{n_done}/{len(pending)}] {aq_file} ({elapsed:.1f}s)")
+            plot_queue.append(aq_file)
+            action and plot_next(aq_file)
+    finally:
+        pool and pool.shutdown()
+    generate_elapsed = max(finished, default=checked) - start
+
+    rate = n_done / generate_elapsed * 60 if generate_elapsed else 0
+    cls_log(
+        f"Generated: {n_done} done, {n_skipped} up to date, {n_failed} failed "
+        f"in {generate_elapsed:.1f}s ({rate:.2f} jobs/min)"
+    )
+    action and cls_log(
+        f"Plotted: {n_plotted} done, {n_plot_failed} failed in {plot_elapsed:.1f}s"
+    )
+    return plot_queue
+
+
+def n_aquatint_pixels_arg(value):
+    "argparse type for --n-aquatint-pixels, MAX or a number of pixels"
+    if value == "MAX":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected MAX or an integer, got {value!r}")
+
+
+def positive_int_arg(value):
+    "argparse type for --workers"
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value!r}")
+    return n
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Image(s) to aquatint to AxiDraw")
+    parser.add_argument("images", nargs="*", help="image file(s) to aquatint")
+    parser.add_argument("--jobs", help="json job file of images and parameter sets")
+    parser.add_argument("--aq-file", help="plot an existing aquatint csv file")
+    parser.add_argument("--output", default="output", help="output folder path")
+    parser.add_argument(
+        "--workers", type=positive_int_arg, default=None, help="process pool size"
+    )
+    parser.add_argument("--force", action="store_true", help="redo up to date jobs")
+    parser.add_argument(
+        "--plot", choices=PLOT_ACTIONS, default=None, help="AxiDraw action per file"
+    )
+    # ProgrammaticAquatint parameters, for images given on the command line
+    parser.add_argument(
+        "--n-aquatint-pixels", type=n_aquatint_pixels_arg, default="MAX"
+    )
+    parser.add_argument("--sample-rate", type=float, default=0.5)
+    parser.add_argument("--use-sampled-image", action="store_true")
+    parser.add_argument("--div-factor", type=float, default=15.0)
+    parser.add_argument("--point-size", type=float, default=0.5)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.aq_file:
+        plot(args.aq_file, args.plot or "size")
+        return
+
+    try:
+        jobs = load_jobs(args.jobs) if args.jobs else []
+    except (OSError, ValueError) as e:
+        cls_log(f"Error: could not load job file: {e}")
+        return
+    params = {
+        "n_aquatint_pixels": args.n_aquatint_pixels,
+        "sample_rate": args.sample_rate,
+        "use_sampled_image": args.use_sampled_image,
+        # Keep whole numbers as ints so output folders match existing ones
+        "data_channel_division_factor": (
+            int(args.div_factor) if args.div_factor.is_integer() else args.div_factor
+        ),
+        "plot_point_size": args.point_size,
+    }
+    jobs += [
+        (os.path.normpath(image_path), args.output, params)
+        for image_path in args.images
+    ]
+    if not jobs:
+        cls_log("Nothing to do, give image file(s), --jobs or --aq-file")
+        return
+    run_jobs(jobs, workers=args.workers, action=args.plot, force=args.force)
+
+
+if __name__ == "__main__":
+    main()